@@ -1,10 +1,9 @@
 # api.py
 from fastapi import FastAPI, File, UploadFile, Request, HTTPException
-from fastapi.responses import Response, StreamingResponse
+from fastapi.responses import Response
 from fastapi.middleware.cors import CORSMiddleware
 from typing import List
-import io 
-from core import run_intelligent_sorter_analysis
+from core import run_intelligent_sorter_analysis, submit_batch_analysis, get_batch_analysis
 from reporting import create_pdf_report, create_excel_report
 
 # --- Initialization and CORS ---
@@ -14,8 +13,25 @@ app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True,
 @app.post("/analyze-intelligent", summary="Analyze a pool of financial documents with auto-classification")
 async def analyze_intelligent_endpoint(documents: List[UploadFile] = File(...)):
     if not documents: raise HTTPException(status_code=400, detail="No files were uploaded.")
-    files_to_process = [{'content': await f.read(), 'filename': f.filename} for f in documents]
-    result = run_intelligent_sorter_analysis(files_to_process)
+    files_to_process = [{'file': f.file, 'filename': f.filename} for f in documents]
+    result = await run_intelligent_sorter_analysis(files_to_process)
+    if "error" in result: raise HTTPException(status_code=500, detail=result["error"])
+    return result
+
+@app.post("/analyze-batch", summary="Queue a pool of financial documents for discounted, non-interactive analysis")
+async def analyze_batch_endpoint(documents: List[UploadFile] = File(...)):
+    """Classifies the documents immediately and queues the extraction via the OpenAI Batch API. Returns a batch id to poll."""
+    if not documents: raise HTTPException(status_code=400, detail="No files were uploaded.")
+    files_to_process = [{'file': f.file, 'filename': f.filename} for f in documents]
+    result = await submit_batch_analysis(files_to_process)
+    if "error" in result: raise HTTPException(status_code=500, detail=result["error"])
+    return result
+
+@app.get("/batch-status/{batch_id}", summary="Poll a queued batch analysis")
+async def batch_status_endpoint(batch_id: str):
+    """Returns the batch status while it is running, or the full analysis result once it has completed."""
+    result = await get_batch_analysis(batch_id)
+    if result is None: raise HTTPException(status_code=404, detail=f"No batch analysis found with id {batch_id}.")
     if "error" in result: raise HTTPException(status_code=500, detail=result["error"])
     return result
 
@@ -26,11 +42,9 @@ async def generate_pdf_endpoint(request: Request):
     analysis_data = await request.json()
     pdf_bytes = create_pdf_report(analysis_data)
     
-    # Wrap the bytes in an in-memory stream for robust handling.
-    pdf_stream = io.BytesIO(pdf_bytes)
-    
+    # The report is already fully in memory, so send it directly rather than re-wrapping it in a stream.
     headers = {"Content-Disposition": "attachment; filename=tax_summary_report.pdf"}
-    return StreamingResponse(pdf_stream, media_type="application/pdf", headers=headers)
+    return Response(content=pdf_bytes, media_type="application/pdf", headers=headers)
 
 @app.post("/generate-report/excel", summary="Generate an Excel summary report")
 async def generate_excel_endpoint(request: Request):
@@ -38,11 +52,8 @@ async def generate_excel_endpoint(request: Request):
     analysis_data = await request.json()
     excel_bytes = create_excel_report(analysis_data)
     
-    # Apply the same robust streaming pattern for consistency.
-    excel_stream = io.BytesIO(excel_bytes)
-    
     headers = {"Content-Disposition": "attachment; filename=tax_summary_report.xlsx"}
-    return StreamingResponse(excel_stream, media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", headers=headers)
+    return Response(content=excel_bytes, media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", headers=headers)
 
 @app.get("/", summary="API Health Check")
 def read_root():
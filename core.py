@@ -1,25 +1,163 @@
 # core.py (Final Production-Grade Version)
 
 # --- Standard Library Imports ---
-import os, io, json, time, traceback, re
+import os, json, asyncio, hashlib, multiprocessing, random, shutil, sqlite3, tempfile, threading, time, traceback, re
+from collections import deque
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 # --- Third-Party Library Imports ---
-import pandas as pd, pdfplumber
-from openai import OpenAI
+import httpx, numpy as np, pandas as pd, pdfplumber, pypdfium2 as pdfium
+from cachetools import LRUCache
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError, RateLimitError
 from dotenv import load_dotenv
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, BinaryIO, Union, Callable, Iterable
 
 # --- 1. Configuration and Initialization ---
 load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# One shared HTTP/2 connection pool, so concurrent OpenAI calls are multiplexed over reused connections
+# and bursts of parallel requests don't run into the default pool limits.
+http_client = httpx.AsyncClient(http2=True, limits=httpx.Limits(max_connections=200, max_keepalive_connections=100), timeout=httpx.Timeout(120.0, connect=5.0))
+# SDK retries are disabled: _run_ai_extraction does its own backoff, and stacking both multiplies attempts and timeouts.
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=http_client, max_retries=0)
+
+# Classification and single-figure override lookups run on a small model; only the main
+# figure extraction needs the larger one. Both can be overridden via environment variables.
+# Both defaults are gpt-4o family models, which OpenAI's automatic prompt caching applies to.
+CLASSIFICATION_MODEL = os.getenv("CLASSIFICATION_MODEL", "gpt-4o-mini")
+HOLISTIC_MODEL = os.getenv("HOLISTIC_MODEL", "gpt-4o")
+
+# PDF/spreadsheet parsing is CPU-bound, so it runs in a process pool instead of blocking the event loop.
+# The pool is created on first use so that, with gunicorn's preload_app, it is started inside each worker
+# rather than in the master before forking. Every gunicorn worker gets its own pool, so by default the CPUs are
+# split across WEB_CONCURRENCY workers (same default as gunicorn_conf.py), with at least one process each.
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", 2 * (os.cpu_count() or 1) + 1))
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY)))
+PARSE_POOL: Optional[ProcessPoolExecutor] = None
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Longer spreadsheets keep their first third and last two thirds of this budget (see _spreadsheet_rows_to_csv).
+SPREADSHEET_MAX_ROWS = 500
+# Guards against pathological uploads that would otherwise run past the gunicorn timeout.
+# Longer PDFs keep their first third and last two thirds of this budget (see _extract_pdf_pages).
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", 300))
+
+# In-process caches keyed on SHA-256 of the input, so byte-identical uploads skip parsing and AI calls.
+# Parsed texts can be whole 300-page documents, so that cache is bounded by total characters rather than entries.
+PARSE_CACHE_MAX_CHARS = int(os.getenv("PARSE_CACHE_MAX_CHARS", 32_000_000))
+_PARSE_CACHE: LRUCache = LRUCache(maxsize=PARSE_CACHE_MAX_CHARS, getsizeof=len)
+_AI_CACHE: LRUCache = LRUCache(maxsize=1000)
+
+# Optional cross-session cache for classification results, enabled only when REDIS_URL is set.
+REDIS_URL = os.getenv("REDIS_URL")
+CLASSIFICATION_CACHE_TTL = 30 * 24 * 3600
+redis_client = None
+if REDIS_URL:
+    import redis.asyncio as aioredis
+    redis_client = aioredis.from_url(REDIS_URL)
+
+# Optional semantic cache: reuses an earlier figure-extraction result when the document text embeds almost
+# identically, e.g. the same return re-uploaded with whitespace/OCR differences. Entries are also keyed on
+# the exact figures in the payload, so documents built from the same template (such as another year's
+# return) can never match each other. Batched classification is never served from this cache.
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", "semantic_cache.sqlite3")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.98))
+SEMANTIC_CACHE_MAX_ENTRIES = 10_000
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_CHAR_LIMIT = 2000
 
 # --- 2. AI Prompts (Final, User-Refined Versions) ---
 
-# This prompt is for the initial, fast classification of each document.
-CLASSIFICATION_PROMPT = """
-You are a Dutch corporate finance document classification assistant.
+# Shared, static preamble placed at the start of every system prompt. Keeping it identical (and above
+# OpenAI's 1024-token minimum) lets all calls hit the automatic prompt cache; only the short task
+# instructions after it and the document text in the user message vary between calls.
+PROMPT_CACHE_KEY = "tax-analyzer-v1"
+SYSTEM_PREAMBLE = """
+You are an assistant that reads financial documents of Dutch legal entities (B.V., N.V., coöperaties, stichtingen
+with business activities) for Dutch corporate income tax (vennootschapsbelasting, "Vpb") preparation, and extracts
+structured data from them. Your output is consumed by software, never by a human.
+
+The sections below are background reference material only. They describe the documents you will see; they do not
+add rules. Always follow the task instructions at the end of this message exactly as written.
+
+### About the document text
+- The document text in the user message may come from PDF text extraction or from a spreadsheet export
+  (rows written as comma-separated values).
+- PDF text can contain broken line wraps, columns that appear out of order, repeated page headers and footers,
+  page numbers and stray characters.
+- Long documents may be shortened; an omitted part is marked with "..." or an "[... pages omitted ...]" or
+  "[... rows omitted ...]" line.
+- Documents may be written in Dutch, English or a mix of both.
+
+### Number notation you may encounter
+- Dutch documents typically write "1.234.567,89" (dot for thousands, comma for decimals).
+- English documents typically write "1,234,567.89" (comma for thousands, dot for decimals).
+- Negative amounts may appear with a leading minus sign, in parentheses such as "(1.234)", or with a trailing minus.
+- Amounts may carry currency symbols (€, EUR) or be shown with a scale note such as "x € 1.000",
+  "bedragen in duizenden euro's", "in thousands of euros" or "x € 1 mln".
+- Financial statements often show the current year next to a comparative prior-year column.
+
+### Dutch financial terminology (Dutch -> English meaning)
+- Winst-en-verliesrekening / resultatenrekening -> Profit and Loss statement (P&L)
+- Jaarrekening / jaarverslag / jaarstukken -> Annual report / financial statements
+- Balans -> Balance sheet
+- Kasstroomoverzicht -> Cash flow statement
+- Toelichting -> Notes to the financial statements
+- Netto-omzet / omzet / opbrengsten -> Revenue / Sales
+- Overige bedrijfsopbrengsten -> Other operating income
+- Kostprijs van de omzet / inkoopwaarde -> Cost of sales
+- Brutomarge / brutowinst -> Gross margin / gross profit
+- Bedrijfslasten / bedrijfskosten / totaal kosten -> Operating expenses / Total expenses
+- Personeelskosten / lonen en salarissen / sociale lasten -> Personnel expenses / wages / social security charges
+- Huisvestingskosten -> Housing / premises costs
+- Verkoopkosten -> Selling expenses
+- Algemene beheerskosten -> General and administrative expenses
+- Afschrijvingen (op materiële en immateriële vaste activa) -> Depreciation and amortization
+- Afschrijvingsstaat / activastaat / investeringsoverzicht -> Depreciation / fixed asset schedule
+- Boekwaarde / aanschafwaarde / restwaarde -> Book value / acquisition cost / residual value
+- Bedrijfsresultaat -> Operating result (EBIT)
+- Financiële baten en lasten / rentelasten -> Financial income and expenses / interest expense
+- Resultaat voor belastingen -> Result before taxes
+- Belastingen naar de winst / vennootschapsbelasting -> Corporate income tax
+- Resultaat na belastingen / nettowinst -> Result after taxes / net profit
+- Eigen vermogen / vreemd vermogen -> Equity / liabilities
+- Vaste activa / vlottende activa -> Fixed assets / current assets
+- Aftrekposten / fiscale faciliteiten -> Tax deductions / tax incentives
+- Investeringsaftrek (KIA, EIA, MIA, Vamil) -> Investment-related tax deductions
+- Innovatiebox, WBSO -> Innovation-related tax incentives
+- Giftenaftrek -> Deduction for gifts to charities
+- Boekjaar / verslagjaar -> Fiscal year
+- Voorraden / debiteuren / crediteuren -> Inventories / trade receivables / trade payables
+- Liquide middelen -> Cash and cash equivalents
+- Voorzieningen -> Provisions
+- Belastbaar bedrag / belastbare winst -> Taxable amount / taxable profit
+- Fiscale eenheid -> Fiscal unity (tax group)
+- Verliesverrekening -> Loss carry-forward / carry-back
+- Deelnemingsvrijstelling -> Participation exemption
+- Samenstellingsverklaring / controleverklaring -> Accountant's compilation report / auditor's report
+
+### Dutch legal entity names
+- Legal forms appear as "B.V.", "BV", "N.V.", "NV", "Holding B.V.", "Coöperatie U.A.", "Stichting".
+- Documents also often mention other parties, such as auditors, accountants, banks and tax advisors.
+
+### Dutch corporate income tax reference (for context only)
+- Standard rates: 19% on taxable profit up to EUR 200,000 and 25.8% on taxable profit above EUR 200,000.
+- Taxable profit is derived from revenue minus deductible expenses, depreciation and specific tax deductions.
+- Fiscal years normally coincide with the calendar year, but may deviate (e.g. 1 July 2023 - 30 June 2024).
+
+### Output format
+- Respond with a single valid JSON object only, exactly as specified in the task.
+
+### Task
+"""
+
+# This prompt is for the initial, fast classification of a batch of documents in a single call.
+CLASSIFICATION_PROMPT = SYSTEM_PREAMBLE + """
+You are acting as a document classification assistant.
 
-Analyze the **first page** of the given financial document text and extract the following fields:
+You will receive a JSON array of documents, each as {"id": 0, "text": "..."} where "text" is the **first page** of a financial document.
+For EVERY document, extract the following fields:
 
 1. **Document Type**: Classify the document into one of these:
    - "P&L_OR_ANNUAL_REPORT"
@@ -34,16 +172,16 @@ Analyze the **first page** of the given financial document text and extract the
    - This could be found in headings, footers, metadata, or report sections.
    - If not found, return: "Unknown Year"
 
-Return ONLY a valid JSON object with this exact format:
+Classify each document independently. Return ONLY a valid JSON object with one entry per input document, using the same "id", in this exact format:
 {
-  "document_type": "CATEGORY_HERE",
-  "company_name": "Company Name B.V.",
-  "fiscal_year": "YYYY"
+  "documents": [
+    {"id": 0, "document_type": "CATEGORY_HERE", "company_name": "Company Name B.V.", "fiscal_year": "YYYY"}
+  ]
 }
 """
 
 # This prompt performs the main analysis on primary documents.
-HOLISTIC_ANALYSIS_PROMPT = """
+HOLISTIC_ANALYSIS_PROMPT = SYSTEM_PREAMBLE + """
 Analyze the provided financial statement text (from a P&L or Annual Report). Your task is to extract the main financial figures for the entire period.
 
 **CRITICAL INSTRUCTIONS:**
@@ -60,96 +198,466 @@ Return ONLY a valid JSON object:
 }
 """
 
+# This prompt classifies a document and extracts its main figures in one call. It is used when a single
+# document is uploaded, so a primary document does not need a separate classification round-trip.
+UNIFIED_EXTRACTION_PROMPT = SYSTEM_PREAMBLE + """
+You are acting as a document classification and financial extraction assistant.
+
+Analyze the given financial document text and extract the following fields:
+
+1. **Document Type**: Classify the document into one of these:
+   - "P&L_OR_ANNUAL_REPORT"
+   - "DEPRECIATION_SCHEDULE"
+   - "DEDUCTIONS_DOCUMENT"
+   - "OTHER"
+
+2. **Company Name**: Extract the full legal entity name (e.g., "XYZ Holding B.V." or "Acme Corp N.V.").
+   - If not found, return: "Unknown Company"
+
+3. **Fiscal Year**: Extract the 4-digit year this document primarily applies to (e.g., 2023).
+   - This could be found in headings, footers, metadata, or report sections.
+   - If not found, return: "Unknown Year"
+
+4. **Financial Figures**: ONLY if the document is a "P&L_OR_ANNUAL_REPORT", extract the main figures for the entire period. Otherwise return 0.0 for each.
+   - Find the final and overall 'Total Revenue' or 'Sales' figure.
+   - For 'Total Expenses', prioritize a pre-calculated value (e.g., 'Total Expenses' or 'Operating Costs'). DO NOT sum individual lines if a total is shown.
+   - For 'Depreciation', use the value only if explicitly mentioned (e.g., "Total Depreciation" or "Amortization").
+   - DO NOT estimate or assume values if they are not explicitly stated.
+
+Return ONLY a valid JSON object with this exact format:
+{
+  "document_type": "CATEGORY_HERE",
+  "company_name": "Company Name B.V.",
+  "fiscal_year": "YYYY",
+  "revenue": 0.0,
+  "expenses": 0.0,
+  "depreciation": 0.0
+}
+"""
+
 # These prompts are for specific, targeted overrides.
-DEPRECIATION_OVERRIDE_PROMPT = 'Analyze this document, which is a depreciation schedule. Your ONLY task is to find the single, final "Total Depreciation" or "Amortization" figure. Return a single JSON object: {"figure": 12345.67}.'
-DEDUCTIONS_OVERRIDE_PROMPT = 'Analyze this document. Your ONLY task is to find the total sum of all "Tax-Deductible Items" or "Tax Credits". Return a single JSON object: {"figure": 12345.67}.'
+DEPRECIATION_OVERRIDE_PROMPT = SYSTEM_PREAMBLE + 'Analyze this document, which is a depreciation schedule. Your ONLY task is to find the single, final "Total Depreciation" or "Amortization" figure. Return a single JSON object: {"figure": 12345.67}.'
+DEDUCTIONS_OVERRIDE_PROMPT = SYSTEM_PREAMBLE + 'Analyze this document. Your ONLY task is to find the total sum of all "Tax-Deductible Items" or "Tax Credits". Return a single JSON object: {"figure": 12345.67}.'
+
+
+# Classification only needs the first page; documents are packed into batched calls to save round-trips.
+CLASSIFICATION_BATCH_SIZE = 8
+CLASSIFICATION_CHAR_LIMIT = 1500
+# Figure extraction sends a head + tail excerpt of each document (see _head_and_tail).
+FIGURES_CHAR_LIMIT = 24000
 
 
 # --- 3. Helper Functions ---
 
+# Built once; str.translate strips these characters in C without going through the regex engine.
+_PUNCTUATION_TABLE = str.maketrans('', '', '.,')
+
 def _normalize_company_name(name: str) -> str:
     """A simple normalizer to handle variations like 'B.V.' vs 'BV' for accurate comparison."""
     if not isinstance(name, str) or name == "Unknown Company": return "unknown"
-    return re.sub(r'[\.,]', '', name.lower()).replace("b v", "bv").replace("n v", "nv").strip()
+    return name.lower().translate(_PUNCTUATION_TABLE).replace("b v", "bv").replace("n v", "nv").strip()
+
+def _extract_pdf_pages(page_count: int, extract_page: Callable[[int], str], filename: str) -> str:
+    """Extracts page texts, keeping at most PDF_MAX_PAGES pages. Totals sit at the end of financial statements,
+    so a long PDF keeps its first third and last two thirds of the budget, with a marker where pages were dropped."""
+    indices = list(range(page_count))
+    if page_count > PDF_MAX_PAGES:
+        head = PDF_MAX_PAGES // 3
+        indices = indices[:head] + indices[page_count - (PDF_MAX_PAGES - head):]
+        print(f"WARNING: {filename} has {page_count} pages; only the first {head} and last {PDF_MAX_PAGES - head} were parsed.")
+    parts, found_text = [], False
+    for position, index in enumerate(indices):
+        if position and index != indices[position - 1] + 1: parts.append(f"[... {index - indices[position - 1] - 1} pages omitted ...]")
+        page_text = extract_page(index)
+        found_text = found_text or bool(page_text.strip())
+        parts.append(page_text)
+    # An image-only PDF yields no text; return "" rather than just the omission marker so callers can fall back.
+    return "\n".join(parts) if found_text else ""
+
+def _extract_pdfium_page(pdf: "pdfium.PdfDocument", index: int) -> str:
+    page = pdf[index]
+    textpage = page.get_textpage()
+    try: return textpage.get_text_range()
+    finally: textpage.close(); page.close()
 
-def _parse_document_content(content: bytes, filename: str) -> str:
-    """Extracts all text from a supported document type."""
+def _extract_pdfplumber_page(pdf: "pdfplumber.PDF", index: int) -> str:
+    page = pdf.pages[index]
+    try: return page.extract_text(x_tolerance=1) or ""
+    finally: page.flush_cache()
+
+def _spreadsheet_rows_to_csv(chunks: Iterable[pd.DataFrame], filename: str) -> str:
+    """Converts spreadsheet rows to compact CSV, keeping at most SPREADSHEET_MAX_ROWS rows. Like _extract_pdf_pages,
+    a long sheet keeps its first third and last two thirds of the budget (where the totals are), with a marker
+    where rows were dropped. Only the first rows and the last two chunks are held in memory."""
+    head_rows = SPREADSHEET_MAX_ROWS // 3
+    tail_rows = SPREADSHEET_MAX_ROWS - head_rows
+    head, tail, total = None, deque(maxlen=2), 0
+    for chunk in chunks:
+        if head is None: head = chunk.iloc[:head_rows]
+        tail.append(chunk)
+        total += len(chunk)
+    if head is None: return ""
+    if total <= SPREADSHEET_MAX_ROWS: return pd.concat(tail).dropna(axis=1, how='all').to_csv(index=False)
+    print(f"WARNING: {filename} has {total} rows; only the first {head_rows} and last {tail_rows} were parsed.")
+    df = pd.concat([head, pd.concat(tail).iloc[-tail_rows:]]).dropna(axis=1, how='all')
+    return df.iloc[:head_rows].to_csv(index=False) + f"[... {total - SPREADSHEET_MAX_ROWS} rows omitted ...]\n" + df.iloc[head_rows:].to_csv(index=False, header=False)
+
+def _parse_document_content(source: Union[str, BinaryIO], filename: str) -> str:
+    """Extracts all text from a supported document (file path or file object). Runs in PARSE_POOL, so it must stay module-level."""
     full_text, filename = "", filename.lower()
     if filename.endswith(".pdf"):
-        with pdfplumber.open(io.BytesIO(content)) as pdf:
-            for page in pdf.pages: full_text += page.extract_text(x_tolerance=1) or "" + "\n"
+        # PDFium extracts text in native code; pdfplumber is only a fallback when it finds nothing.
+        # Each page is released right after extraction so long reports don't keep every page in memory.
+        pdf = pdfium.PdfDocument(source)
+        try: full_text = _extract_pdf_pages(len(pdf), lambda index: _extract_pdfium_page(pdf, index), filename)
+        finally: pdf.close()
+        if not full_text.strip():
+            if not isinstance(source, str): source.seek(0)
+            with pdfplumber.open(source) as pdf:
+                full_text = _extract_pdf_pages(len(pdf.pages), lambda index: _extract_pdfplumber_page(pdf, index), filename)
     elif filename.endswith((".csv", ".xls", ".xlsx")):
-        df = pd.read_excel(io.BytesIO(content)) if 'xls' in filename else pd.read_csv(io.BytesIO(content))
-        full_text = df.to_string()
+        # Figure extraction needs the totals at the bottom of the sheet, so keep a head and a tail of rows.
+        # CSV is streamed in chunks so long files are never fully loaded; Excel sheets can't be read from the end.
+        if 'xls' in filename: full_text = _spreadsheet_rows_to_csv([pd.read_excel(source)], filename)
+        else: full_text = _spreadsheet_rows_to_csv(pd.read_csv(source, chunksize=SPREADSHEET_MAX_ROWS - SPREADSHEET_MAX_ROWS // 3), filename)
     return full_text
 
-def _run_ai_extraction(text: str, prompt: str) -> Dict[str, Any]:
-    """A generic helper to run any prompt against provided text, with retries."""
+def _upload_cache_key(fileobj: BinaryIO, filename: str) -> str:
+    """Hashes an uploaded file in chunks, without reading it into memory, to key the parse cache."""
+    digest = hashlib.sha256()
+    fileobj.seek(0)
+    for chunk in iter(lambda: fileobj.read(UPLOAD_CHUNK_SIZE), b""): digest.update(chunk)
+    fileobj.seek(0)
+    return f"{os.path.splitext(filename.lower())[1]}:{digest.hexdigest()}"
+
+def _spool_to_disk(fileobj: BinaryIO, filename: str) -> str:
+    """Copies an uploaded file to a named temporary file so PARSE_POOL workers can open it by path."""
+    with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(filename.lower())[1]) as tmp:
+        fileobj.seek(0)
+        shutil.copyfileobj(fileobj, tmp, UPLOAD_CHUNK_SIZE)
+    return tmp.name
+
+def _get_parse_pool() -> ProcessPoolExecutor:
+    global PARSE_POOL
+    # forkserver (spawn where it's unavailable, e.g. Windows) rather than the default fork: by now the worker is
+    # multi-threaded (asyncio.to_thread), and forking a threaded process can deadlock the child; fork would also copy
+    # this worker's caches into every parser process.
+    if PARSE_POOL is None:
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        PARSE_POOL = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context(start_method))
+    return PARSE_POOL
+
+async def _parse_documents(files: List[Dict[str, Any]]) -> List[str]:
+    """Parses all uploaded file objects in parallel on PARSE_POOL. Results are cached on the SHA-256 of the content."""
+    global PARSE_POOL
+    loop = asyncio.get_running_loop()
+    cache_keys = await asyncio.gather(*[asyncio.to_thread(_upload_cache_key, doc['file'], doc['filename']) for doc in files])
+    pending = [i for i, key in enumerate(cache_keys) if key not in _PARSE_CACHE]
+    paths = await asyncio.gather(*[asyncio.to_thread(_spool_to_disk, files[i]['file'], files[i]['filename']) for i in pending])
+    try:
+        parsed = await asyncio.gather(*[loop.run_in_executor(_get_parse_pool(), _parse_document_content, path, files[i]['filename']) for i, path in zip(pending, paths)])
+    except BrokenProcessPool:
+        # A parser process died (e.g. a malformed PDF crashed PDFium). A broken pool rejects all later work,
+        # so drop it and let the next request start a fresh one.
+        if PARSE_POOL is not None: PARSE_POOL.shutdown(wait=False, cancel_futures=True)
+        PARSE_POOL = None
+        raise
+    finally:
+        for path in paths: os.remove(path)
+    texts = [_PARSE_CACHE.get(key) for key in cache_keys]
+    for i, text in zip(pending, parsed):
+        texts[i] = text
+        if len(text) <= PARSE_CACHE_MAX_CHARS: _PARSE_CACHE[cache_keys[i]] = text
+    return texts
+
+class _SemanticCache:
+    """An in-memory cosine-similarity index of previous AI results, persisted to SQLite and bounded with LRU eviction.
+    Entries are scoped to a namespace (see _semantic_cache_namespace) so a result is only reused for the same kind of call.
+    Each worker keeps its own index; the SQLite table they share is trimmed to max_entries on every insert.
+    lookup() and add() do blocking SQLite I/O and are meant to be run via asyncio.to_thread; a lock guards the index."""
+
+    def __init__(self, path: str, max_entries: int, threshold: float):
+        self.path, self.max_entries, self.threshold = path, max_entries, threshold
+        self.size, self.clock, self.vectors = 0, 0, None
+        self.namespace_ids, self.last_used = np.zeros(max_entries, dtype=np.int64), np.zeros(max_entries, dtype=np.int64)
+        self.results: List[Optional[Dict[str, Any]]] = [None] * max_entries
+        self.row_ids: List[Optional[int]] = [None] * max_entries
+        self._lock = threading.Lock()
+        with closing(self._db()) as conn:
+            rows = conn.execute("SELECT id, namespace, vector, result, last_used FROM semantic_cache ORDER BY last_used DESC LIMIT ?", (max_entries,)).fetchall()
+        self.clock = rows[0][4] if rows else 0
+        for row_id, namespace, vector, result, last_used in reversed(rows):
+            self._store(self.size, row_id, namespace, np.frombuffer(vector, dtype=np.float32), json.loads(result), last_used)
+            self.size += 1
+
+    def _db(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=5)
+        conn.execute("CREATE TABLE IF NOT EXISTS semantic_cache (id INTEGER PRIMARY KEY, namespace TEXT NOT NULL, vector BLOB NOT NULL, result TEXT NOT NULL, last_used INTEGER NOT NULL)")
+        return conn
+
+    @staticmethod
+    def _namespace_id(namespace: str) -> int:
+        """Folds a namespace into a fixed-width int64 so it is stored per slot rather than interned."""
+        return int(np.frombuffer(hashlib.sha256(namespace.encode()).digest()[:8], dtype=np.int64)[0])
+
+    def _tick(self) -> int:
+        """Returns the next last_used value: wall-clock nanoseconds, so workers sharing the table order entries consistently."""
+        self.clock = max(self.clock + 1, time.time_ns())
+        return self.clock
+
+    def _store(self, slot: int, row_id: int, namespace: str, vector: np.ndarray, result: Dict[str, Any], last_used: int) -> None:
+        if self.vectors is None: self.vectors = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+        self.vectors[slot], self.last_used[slot] = vector, last_used
+        self.namespace_ids[slot] = self._namespace_id(namespace)
+        self.results[slot], self.row_ids[slot] = result, row_id
+
+    def lookup(self, namespace: str, vector: np.ndarray) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            if self.vectors is None: return None
+            candidates = np.flatnonzero(self.namespace_ids[:self.size] == self._namespace_id(namespace))
+            if candidates.size == 0: return None
+            similarities = self.vectors[candidates] @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold: return None
+            slot = int(candidates[best])
+            self.last_used[slot] = last_used = self._tick()
+            row_id, result = self.row_ids[slot], self.results[slot]
+        # Only the recency bookkeeping is persisted here; the in-memory hit is valid even if this write fails.
+        try:
+            with closing(self._db()) as conn, conn:
+                conn.execute("UPDATE semantic_cache SET last_used = ? WHERE id = ?", (last_used, row_id))
+        except sqlite3.Error as e:
+            print(f"WARNING: Semantic cache could not persist last_used: {e}")
+        return result
+
+    def add(self, namespace: str, vector: np.ndarray, result: Dict[str, Any]) -> None:
+        with self._lock:
+            slot = self.size if self.size < self.max_entries else int(np.argmin(self.last_used))
+            last_used = self._tick()
+            with closing(self._db()) as conn, conn:
+                if slot < self.size: conn.execute("DELETE FROM semantic_cache WHERE id = ?", (self.row_ids[slot],))
+                row_id = conn.execute("INSERT INTO semantic_cache (namespace, vector, result, last_used) VALUES (?, ?, ?, ?)", (namespace, vector.astype(np.float32).tobytes(), json.dumps(result), last_used)).lastrowid
+                # Other workers insert into the same table, so bound it here rather than only evicting this worker's rows.
+                conn.execute("DELETE FROM semantic_cache WHERE id NOT IN (SELECT id FROM semantic_cache ORDER BY last_used DESC LIMIT ?)", (self.max_entries,))
+            self._store(slot, row_id, namespace, vector, result, last_used)
+            self.size = max(self.size, slot + 1)
+
+_SEMANTIC_CACHE: Optional[_SemanticCache] = None
+_SEMANTIC_CACHE_LOCK = threading.Lock()
+
+def _get_semantic_cache() -> _SemanticCache:
+    """Loads the semantic cache on first use rather than at import, since PARSE_POOL processes import this module too."""
+    global _SEMANTIC_CACHE
+    with _SEMANTIC_CACHE_LOCK:
+        if _SEMANTIC_CACHE is None: _SEMANTIC_CACHE = _SemanticCache(SEMANTIC_CACHE_PATH, SEMANTIC_CACHE_MAX_ENTRIES, SEMANTIC_CACHE_THRESHOLD)
+    return _SEMANTIC_CACHE
+
+_NUMBER_RE = re.compile(r'\d[\d.,]*')
+
+def _semantic_cache_namespace(text: str, prompt: str, model: str) -> str:
+    """Scopes semantic matches to the same model, prompt and exact sequence of numbers in the payload."""
+    figures = " ".join(_NUMBER_RE.findall(text[:32000]))
+    return hashlib.sha256((model + prompt + figures).encode()).hexdigest()
+
+async def _semantic_cache_lookup(namespace: str, embedding: np.ndarray) -> Optional[Dict[str, Any]]:
+    """Runs a semantic cache lookup off the event loop. Cache failures are logged and treated as misses."""
+    try: return await asyncio.to_thread(lambda: _get_semantic_cache().lookup(namespace, embedding))
+    except (sqlite3.Error, ValueError) as e:
+        print(f"WARNING: Semantic cache lookup failed: {e}")
+        return None
+
+async def _semantic_cache_add(namespace: str, embedding: np.ndarray, result: Dict[str, Any]) -> None:
+    """Stores a result in the semantic cache off the event loop. Cache failures are logged and ignored."""
+    try: await asyncio.to_thread(lambda: _get_semantic_cache().add(namespace, embedding, result))
+    except (sqlite3.Error, ValueError) as e:
+        print(f"WARNING: Semantic cache store failed: {e}")
+
+async def _embed_for_semantic_cache(text: str) -> Optional[np.ndarray]:
+    """Embeds the end of a payload, where the totals are, as a unit vector. Returns None if the embedding call fails."""
+    try:
+        response = await client.embeddings.create(model=EMBEDDING_MODEL, input=text[:32000][-EMBEDDING_CHAR_LIMIT:])
+        vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+    except Exception as e:
+        print(f"WARNING: Semantic cache embedding failed: {e}")
+        return None
+
+def _head_and_tail(text: str, limit: int = FIGURES_CHAR_LIMIT) -> str:
+    """Trims text for figure extraction: totals sit near the end of financial statements, so keep
+    the first third of the budget from the start (entity and period) and the rest from the end."""
+    if len(text) <= limit: return text
+    head = limit // 3
+    return text[:head] + "\n...\n" + text[-(limit - head):]
+
+def _build_chat_request(text: str, prompt: str, model: str) -> Dict[str, Any]:
+    """Builds the chat completion request body shared by live calls and Batch API requests."""
+    return {"model": model, "messages": [{"role": "system", "content": prompt}, {"role": "user", "content": text[:32000]}], "temperature": 0, "response_format": {"type": "json_object"}, "prompt_cache_key": PROMPT_CACHE_KEY}
+
+def _is_retryable(error: Exception) -> bool:
+    """Rate limits, connection failures and timeouts, 5xx responses and malformed JSON can succeed on a retry; other errors can't."""
+    if isinstance(error, (RateLimitError, APIConnectionError, json.JSONDecodeError)): return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
+async def _run_ai_extraction(text: str, prompt: str, model: str = CLASSIFICATION_MODEL) -> Dict[str, Any]:
+    """A generic helper to run any prompt against provided text, with retries. Successful results are cached."""
+    cache_key = hashlib.sha256((model + prompt + text[:32000]).encode()).hexdigest()
+    if cache_key in _AI_CACHE: return _AI_CACHE[cache_key]
+    embedding = None
+    if SEMANTIC_CACHE_ENABLED and prompt is not CLASSIFICATION_PROMPT and (embedding := await _embed_for_semantic_cache(text)) is not None:
+        namespace = _semantic_cache_namespace(text, prompt, model)
+        cached = await _semantic_cache_lookup(namespace, embedding)
+        if cached is not None: return cached
     for attempt in range(3):
         try:
-            response = client.chat.completions.create(model="gpt-4-turbo", messages=[{"role": "system", "content": prompt}, {"role": "user", "content": text[:32000]}], temperature=0, response_format={"type": "json_object"})
-            return json.loads(response.choices[0].message.content.strip())
+            request = _build_chat_request(text, prompt, model)
+            # Sent via extra_body so SDK versions without a prompt_cache_key keyword still work.
+            cache_routing = {"prompt_cache_key": request.pop("prompt_cache_key")}
+            response = await client.chat.completions.create(**request, extra_body=cache_routing)
+            result = json.loads(response.choices[0].message.content.strip())
+            break
         except Exception as e:
+            if not _is_retryable(e):
+                print(f"ERROR: AI extraction failed with a non-retryable error: {e}")
+                return {"error": str(e)}
             print(f"ERROR: AI extraction attempt {attempt + 1} failed: {e}")
             if attempt == 2: return {"error": str(e)}
-            time.sleep(3)
-    return {"error": "AI extraction failed after all retries."}
+            # Exponential backoff with jitter (1s, 2s, ...) so concurrent calls don't retry in lockstep.
+            await asyncio.sleep(min(2 ** attempt, 8) + random.random())
+    else: return {"error": "AI extraction failed after all retries."}
+
+    # Caching happens outside the retry loop so a cache failure never re-sends a completed call.
+    _AI_CACHE[cache_key] = result
+    if embedding is not None: await _semantic_cache_add(namespace, embedding, result)
+    return result
+
+
+async def _classify_batch(texts: List[str]) -> Optional[List[Dict[str, Any]]]:
+    """Classifies a batch of documents in one call. Returns None if the response does not cover every id."""
+    payload = json.dumps([{"id": i, "text": text[:CLASSIFICATION_CHAR_LIMIT]} for i, text in enumerate(texts)], ensure_ascii=False)
+    result = await _run_ai_extraction(payload, CLASSIFICATION_PROMPT)
+    entries = result.get("documents")
+    if not isinstance(entries, list): return None
+    by_id = {}
+    for entry in entries:
+        # The model sometimes echoes ids as strings ("0"), so normalize them before matching.
+        try: by_id[int(entry["id"])] = entry
+        except (TypeError, KeyError, ValueError): continue
+    if any(i not in by_id for i in range(len(texts))): return None
+    return [by_id[i] for i in range(len(texts))]
+
+# Ties cached classifications to the model and prompt that produced them, so changing either invalidates them.
+_CLASSIFICATION_CACHE_VERSION = hashlib.sha256((CLASSIFICATION_MODEL + CLASSIFICATION_PROMPT).encode()).hexdigest()[:16]
+
+def _classification_cache_key(text: str) -> str:
+    return f"tax-analyzer:classification:{_CLASSIFICATION_CACHE_VERSION}:{hashlib.sha256(text[:CLASSIFICATION_CHAR_LIMIT].encode()).hexdigest()}"
+
+async def _get_cached_classifications(texts: List[str]) -> List[Optional[Dict[str, Any]]]:
+    """Looks up previous classification results in Redis. Returns None entries for misses or when Redis is unavailable."""
+    if redis_client is None or not texts: return [None] * len(texts)
+    try:
+        cached = await redis_client.mget([_classification_cache_key(text) for text in texts])
+        return [json.loads(value) if value else None for value in cached]
+    except Exception as e:
+        print(f"WARNING: Redis classification cache lookup failed: {e}")
+        return [None] * len(texts)
+
+async def _store_cached_classifications(texts: List[str], results: List[Dict[str, Any]]) -> None:
+    """Stores classification results in Redis so they can be reused across sessions and workers."""
+    if redis_client is None or not texts: return
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for text, result in zip(texts, results): pipe.set(_classification_cache_key(text), json.dumps(result), ex=CLASSIFICATION_CACHE_TTL)
+            await pipe.execute()
+    except Exception as e:
+        print(f"WARNING: Redis classification cache store failed: {e}")
+
+async def _classify_documents(texts: List[str]) -> List[Dict[str, Any]]:
+    """Classifies all documents in batches of CLASSIFICATION_BATCH_SIZE, falling back to one call per document for failed batches."""
+    results = await _get_cached_classifications(texts)
+    pending = [i for i, result in enumerate(results) if result is None]
+    batches = [pending[i:i + CLASSIFICATION_BATCH_SIZE] for i in range(0, len(pending), CLASSIFICATION_BATCH_SIZE)]
+    batch_results = await asyncio.gather(*[_classify_batch([texts[i] for i in batch]) for batch in batches])
+    fresh_texts, fresh_results = [], []
+    for batch, batch_result in zip(batches, batch_results):
+        if batch_result is None:
+            print(f"WARNING: Batched classification failed validation; retrying {len(batch)} document(s) individually.")
+            single_results = await asyncio.gather(*[_classify_batch([texts[i]]) for i in batch])
+            batch_result = [single[0] if single else None for single in single_results]
+        for i, result in zip(batch, batch_result):
+            if result is None: results[i] = {"document_type": "OTHER"}; continue
+            results[i] = result
+            fresh_texts.append(texts[i]); fresh_results.append(result)
+    await _store_cached_classifications(fresh_texts, fresh_results)
+    return results
 
 
 # --- 4. The Main Orchestrator Function ---
-def run_intelligent_sorter_analysis(files: List[Dict[str, Any]]) -> Dict[str, Any]:
-    """Orchestrates the "Intelligent Sorter" pipeline with company and fiscal year validation."""
+async def _classify_and_validate(files: List[Dict[str, Any]], allow_unified: bool = True) -> Dict[str, Any]:
+    """Steps 1 and 1.5: parses and classifies all documents, then validates company, fiscal year and primary document."""
     classified_docs = {'P&L_OR_ANNUAL_REPORT': [], 'DEPRECIATION_SCHEDULE': [], 'DEDUCTIONS_DOCUMENT': []}
     company_names, fiscal_years, file_metadata = set(), set(), []
 
-    # Step 1: Classify each document and extract metadata
-    for doc in files:
-        text = _parse_document_content(doc['content'], doc['filename'])
-        if not text: continue
-        
-        classification_result = _run_ai_extraction(text[:2500], CLASSIFICATION_PROMPT)
+    # Step 1: Parse every document, then classify them in batched calls.
+    # A single document is classified and analyzed in one unified call instead.
+    try: parsed_texts = await _parse_documents(files)
+    except BrokenProcessPool: return {"error": "Analysis failed. One of the uploaded documents crashed the document parser. Please check that all files are valid, unencrypted PDF, CSV or Excel files."}
+    parsed_docs = list(zip([doc['filename'] for doc in files], parsed_texts))
+    parsed_docs = [(filename, text) for filename, text in parsed_docs if text]
+    unified_data = None
+    if allow_unified and len(parsed_docs) == 1:
+        unified_data = await _run_ai_extraction(_head_and_tail(parsed_docs[0][1]), UNIFIED_EXTRACTION_PROMPT, model=HOLISTIC_MODEL)
+        classification_results = [unified_data]
+    else:
+        classification_results = await _classify_documents([text for _, text in parsed_docs])
+
+    for (filename, text), classification_result in zip(parsed_docs, classification_results):
         doc_type = classification_result.get("document_type", "OTHER")
         company_name = classification_result.get("company_name")
         fiscal_year = classification_result.get("fiscal_year")
         
-        file_metadata.append({"filename": doc['filename'], "type": doc_type, "company_name_detected": company_name, "fiscal_year_detected": fiscal_year})
+        file_metadata.append({"filename": filename, "type": doc_type, "company_name_detected": company_name, "fiscal_year_detected": fiscal_year})
         if company_name and company_name != "Unknown Company": company_names.add(_normalize_company_name(company_name))
         if fiscal_year and fiscal_year != "Unknown Year": fiscal_years.add(str(fiscal_year))
         
         if doc_type in classified_docs:
-            classified_docs[doc_type].append({'text': text, 'filename': doc['filename']})
+            classified_docs[doc_type].append({'text': text, 'filename': filename})
 
     # Step 1.5: CRITICAL VALIDATION CHECKS
     if len(company_names) > 1: return {"error": f"Analysis failed. Documents from multiple companies were detected: {list(company_names)}. Please upload documents for only one company."}
     if len(fiscal_years) > 1: return {"error": f"Analysis failed. Documents from multiple fiscal years were detected: {list(fiscal_years)}. Please upload documents for a single year only."}
+    if not classified_docs['P&L_OR_ANNUAL_REPORT']: return {"error": "Analysis failed. No primary financial document (P&L or Annual Report) was found."}
 
-    final_company_name = list(company_names)[0].title() if company_names else "Unknown Company"
-    final_fiscal_year = list(fiscal_years)[0] if fiscal_years else "Unknown Year"
-
-    # Step 2 & 3: Holistic Analysis and Overrides
-    primary_docs = classified_docs['P&L_OR_ANNUAL_REPORT']
-    if not primary_docs: return {"error": "Analysis failed. No primary financial document (P&L or Annual Report) was found."}
-    
-    holistic_text = "\n\n--- END OF DOCUMENT ---\n\n".join([doc['text'] for doc in primary_docs])
-    holistic_data = _run_ai_extraction(holistic_text, HOLISTIC_ANALYSIS_PROMPT)
-    if "error" in holistic_data: return {"error": f"Holistic analysis failed: {holistic_data['error']}"}
+    return {
+        "company_name": list(company_names)[0].title() if company_names else "Unknown Company",
+        "fiscal_year": list(fiscal_years)[0] if fiscal_years else "Unknown Year",
+        "file_metadata": file_metadata,
+        "classified_docs": classified_docs,
+        "unified_data": unified_data
+    }
 
+def _build_tax_summary(context: Dict[str, Any], holistic_data: Dict[str, Any], depreciation_data: Optional[Dict[str, Any]], deduction_results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Steps 3 to 5: applies the override figures, calculates the tax owed and builds the final response."""
+    classified_docs = context['classified_docs']
     revenue, expenses, depreciation = float(holistic_data.get("revenue") or 0.0), float(holistic_data.get("expenses") or 0.0), float(holistic_data.get("depreciation") or 0.0)
     audit_flags = []
     
     if classified_docs['DEPRECIATION_SCHEDULE']:
         dep_doc = classified_docs['DEPRECIATION_SCHEDULE'][0]
-        override_data = _run_ai_extraction(dep_doc['text'], DEPRECIATION_OVERRIDE_PROMPT)
-        new_dep_val = override_data.get("figure", depreciation)
-        depreciation = float(new_dep_val or 0.0)
-        audit_flags.append(f"ℹ️ Depreciation value of {depreciation:,.2f} was taken from override document: {dep_doc['filename']}")
+        if depreciation_data is None or "error" in depreciation_data:
+            audit_flags.append(f"⚠️ Depreciation could not be read from override document {dep_doc['filename']}; the value of {depreciation:,.2f} from the main analysis was used instead.")
+        else:
+            new_dep_val = depreciation_data.get("figure", depreciation)
+            depreciation = float(new_dep_val or 0.0)
+            audit_flags.append(f"ℹ️ Depreciation value of {depreciation:,.2f} was taken from override document: {dep_doc['filename']}")
 
     deductions = 0.0
     if classified_docs['DEDUCTIONS_DOCUMENT']:
-        for ded_doc in classified_docs['DEDUCTIONS_DOCUMENT']:
-            override_data = _run_ai_extraction(ded_doc['text'], DEDUCTIONS_OVERRIDE_PROMPT)
-            deductions += float(override_data.get("figure", 0.0))
+        succeeded = [override_data for override_data in deduction_results if "error" not in override_data]
+        figures = np.fromiter((float(override_data.get("figure") or 0.0) for override_data in succeeded), dtype=np.float64, count=len(succeeded))
+        deductions = float(figures.sum())
         audit_flags.append(f"ℹ️ Deductions of {deductions:,.2f} were calculated from supplemental document(s).")
+        failed = [doc['filename'] for doc, override_data in zip(classified_docs['DEDUCTIONS_DOCUMENT'], deduction_results) if "error" in override_data]
+        if failed: audit_flags.append(f"⚠️ Deductions could not be read from: {', '.join(failed)}. These documents were not included in the total.")
 
     # Step 4 & 5: Final Calculation and Reporting
     net_taxable_income = revenue - expenses - depreciation - deductions
@@ -164,7 +672,7 @@ def run_intelligent_sorter_analysis(files: List[Dict[str, Any]]) -> Dict[str, An
     if depreciation == 0.0 and not classified_docs['DEPRECIATION_SCHEDULE']: audit_flags.append("⚠️ Depreciation not found and no specific schedule was provided. Assumed to be zero.")
 
     return {
-        "general_information": {"company_name": final_company_name, "fiscal_year": final_fiscal_year},
+        "general_information": {"company_name": context['company_name'], "fiscal_year": context['fiscal_year']},
         "tax_return_summary": {
             "breakdown": {
                 "Revenue": revenue, "Expenses": expenses, "Depreciation": depreciation,
@@ -172,6 +680,125 @@ def run_intelligent_sorter_analysis(files: List[Dict[str, Any]]) -> Dict[str, An
                 "Applied Tax Rate": applied_tax_rate, "Final Tax Owed": max(0, tax_owed)
             }
         },
-        "file_metadata": file_metadata,
+        "file_metadata": context['file_metadata'],
         "audit_flags": audit_flags
     }
+
+def _join_primary_docs(primary_docs: List[Dict[str, Any]]) -> str:
+    limit = FIGURES_CHAR_LIMIT // len(primary_docs)
+    return "\n\n--- END OF DOCUMENT ---\n\n".join([_head_and_tail(doc['text'], limit) for doc in primary_docs])
+
+async def run_intelligent_sorter_analysis(files: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Orchestrates the "Intelligent Sorter" pipeline with company and fiscal year validation."""
+    context = await _classify_and_validate(files)
+    if "error" in context: return context
+    classified_docs = context['classified_docs']
+
+    # Step 2 & 3: Holistic Analysis and Overrides
+    if context['unified_data'] is not None:
+        holistic_data = context['unified_data']
+    else:
+        holistic_data = await _run_ai_extraction(_join_primary_docs(classified_docs['P&L_OR_ANNUAL_REPORT']), HOLISTIC_ANALYSIS_PROMPT, model=HOLISTIC_MODEL)
+    if "error" in holistic_data: return {"error": f"Holistic analysis failed: {holistic_data['error']}"}
+
+    depreciation_data = None
+    if classified_docs['DEPRECIATION_SCHEDULE']:
+        depreciation_data = await _run_ai_extraction(_head_and_tail(classified_docs['DEPRECIATION_SCHEDULE'][0]['text']), DEPRECIATION_OVERRIDE_PROMPT)
+    deduction_results = await asyncio.gather(*[_run_ai_extraction(_head_and_tail(ded_doc['text']), DEDUCTIONS_OVERRIDE_PROMPT) for ded_doc in classified_docs['DEDUCTIONS_DOCUMENT']])
+
+    return _build_tax_summary(context, holistic_data, depreciation_data, deduction_results)
+
+
+# --- 5. Batch API Pipeline (Non-Interactive) ---
+# Holistic and override extractions for queued jobs go through OpenAI's Batch API (50% cheaper, up to 24h turnaround).
+# Classification still runs live so documents can be validated before anything is queued.
+BATCH_DB_PATH = os.getenv("BATCH_DB_PATH", "batch_jobs.sqlite3")
+
+def _batch_db() -> sqlite3.Connection:
+    conn = sqlite3.connect(BATCH_DB_PATH)
+    conn.execute("CREATE TABLE IF NOT EXISTS batch_jobs (batch_id TEXT PRIMARY KEY, context TEXT NOT NULL, result TEXT)")
+    return conn
+
+def _save_batch_job(batch_id: str, context: Dict[str, Any]) -> None:
+    with closing(_batch_db()) as conn, conn:
+        conn.execute("INSERT INTO batch_jobs (batch_id, context) VALUES (?, ?)", (batch_id, json.dumps(context)))
+
+def _save_batch_result(batch_id: str, result: Dict[str, Any]) -> None:
+    with closing(_batch_db()) as conn, conn:
+        conn.execute("UPDATE batch_jobs SET result = ? WHERE batch_id = ?", (json.dumps(result), batch_id))
+
+def _load_batch_job(batch_id: str) -> Optional[Dict[str, Any]]:
+    with closing(_batch_db()) as conn:
+        row = conn.execute("SELECT context, result FROM batch_jobs WHERE batch_id = ?", (batch_id,)).fetchone()
+    if row is None: return None
+    return {"context": json.loads(row[0]), "result": json.loads(row[1]) if row[1] else None}
+
+def _parse_batch_output(entry: Dict[str, Any]) -> Dict[str, Any]:
+    """Extracts the JSON answer from one line of a Batch API output or error file."""
+    response = entry.get("response") or {}
+    if entry.get("error") or response.get("status_code") != 200: return {"error": str(entry.get("error") or response.get("body"))}
+    try: return json.loads(response["body"]["choices"][0]["message"]["content"].strip())
+    except (KeyError, IndexError, TypeError, ValueError) as e: return {"error": f"Malformed batch output: {e}"}
+
+async def _read_batch_file(file_id: Optional[str]) -> Dict[str, Dict[str, Any]]:
+    """Downloads a Batch API output or error file and parses each line, keyed by custom_id."""
+    results = {}
+    if not file_id: return results
+    batch_file = await client.files.content(file_id)
+    for line in batch_file.text.splitlines():
+        if line.strip():
+            entry = json.loads(line)
+            results[entry["custom_id"]] = _parse_batch_output(entry)
+    return results
+
+async def submit_batch_analysis(files: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Classifies and validates the documents, then queues the extraction calls as an OpenAI batch."""
+    context = await _classify_and_validate(files, allow_unified=False)
+    if "error" in context: return context
+    classified_docs = context['classified_docs']
+
+    requests = {"holistic": _build_chat_request(_join_primary_docs(classified_docs['P&L_OR_ANNUAL_REPORT']), HOLISTIC_ANALYSIS_PROMPT, HOLISTIC_MODEL)}
+    if classified_docs['DEPRECIATION_SCHEDULE']:
+        requests["depreciation"] = _build_chat_request(_head_and_tail(classified_docs['DEPRECIATION_SCHEDULE'][0]['text']), DEPRECIATION_OVERRIDE_PROMPT, CLASSIFICATION_MODEL)
+    for i, ded_doc in enumerate(classified_docs['DEDUCTIONS_DOCUMENT']):
+        requests[f"deductions-{i}"] = _build_chat_request(_head_and_tail(ded_doc['text']), DEDUCTIONS_OVERRIDE_PROMPT, CLASSIFICATION_MODEL)
+
+    batch_input = "\n".join(json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body}) for custom_id, body in requests.items())
+    try:
+        input_file = await client.files.create(file=("batch_input.jsonl", batch_input.encode()), purpose="batch")
+        batch = await client.batches.create(input_file_id=input_file.id, endpoint="/v1/chat/completions", completion_window="24h")
+    except Exception as e:
+        print(f"ERROR: Batch submission failed: {e}")
+        return {"error": f"Batch submission failed: {e}"}
+
+    # Document texts are not needed once the batch is queued; only filenames are kept for the audit flags.
+    stored_context = {key: context[key] for key in ("company_name", "fiscal_year", "file_metadata")}
+    stored_context['classified_docs'] = {doc_type: [{'filename': doc['filename']} for doc in docs] for doc_type, docs in classified_docs.items()}
+    await asyncio.to_thread(_save_batch_job, batch.id, stored_context)
+    return {"batch_id": batch.id, "status": batch.status}
+
+async def get_batch_analysis(batch_id: str) -> Optional[Dict[str, Any]]:
+    """Returns the batch status while it is running, or the final analysis once complete. Returns None for unknown ids."""
+    job = await asyncio.to_thread(_load_batch_job, batch_id)
+    if job is None: return None
+    if job['result'] is not None: return job['result']
+    context = job['context']
+
+    try:
+        batch = await client.batches.retrieve(batch_id)
+        if batch.status in ("failed", "expired", "cancelled"): return {"error": f"Batch analysis {batch_id} did not complete (status: {batch.status})."}
+        if batch.status != "completed": return {"batch_id": batch_id, "status": batch.status}
+        # Requests that failed are written to the error file, not the output file.
+        outputs = {**await _read_batch_file(batch.error_file_id), **await _read_batch_file(batch.output_file_id)}
+    except Exception as e:
+        print(f"ERROR: Could not retrieve batch analysis {batch_id}: {e}")
+        return {"error": f"Could not retrieve batch analysis {batch_id}: {e}"}
+
+    missing = {"error": "No result was returned for this request."}
+    holistic_data = outputs.get("holistic", missing)
+    if "error" in holistic_data: result = {"error": f"Holistic analysis failed: {holistic_data['error']}"}
+    else:
+        deduction_results = [outputs.get(f"deductions-{i}", missing) for i in range(len(context['classified_docs']['DEDUCTIONS_DOCUMENT']))]
+        result = _build_tax_summary(context, holistic_data, outputs.get("depreciation", missing), deduction_results)
+    await asyncio.to_thread(_save_batch_result, batch_id, result)
+    return result
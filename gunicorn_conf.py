@@ -8,8 +8,18 @@ port = os.environ.get("PORT", "8000")
 bind = f"{host}:{port}"
 
 # Worker processes
-workers = int(os.environ.get("WEB_CONCURRENCY", 3))
+# Requests spend most of their time awaiting OpenAI, so each async worker serves many requests at once.
+# preload_app imports the app once in the master so workers share the client, prompts and caches copy-on-write.
+workers = int(os.environ.get("WEB_CONCURRENCY", 2 * (os.cpu_count() or 1) + 1))
 worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+
+# Each worker also owns a document parsing pool of PARSE_WORKERS processes (read in core.py). It defaults to
+# CPUs // WEB_CONCURRENCY, at least 1, so lowering WEB_CONCURRENCY gives each upload more parsing processes;
+# with the default worker count that is one per worker, as the web workers already cover every CPU.
+
+# Keep idle HTTP/1.1 connections open for reuse (passed to uvicorn as its keep-alive timeout)
+keepalive = 5
 
 # Timeout setting for long-running AI calls
 timeout = 180
@@ -1,7 +1,7 @@
 # reporting.py (Final Enhanced Version)
 
 import io
-import pandas as pd
+import xlsxwriter
 from fpdf import FPDF
 from typing import Dict, Any
 
@@ -14,6 +14,10 @@ def _format_currency(amount: float) -> str:
     """A consistent helper to format numbers into a currency string."""
     return f"EUR {amount:,.2f}" if isinstance(amount, (int, float)) else str(amount)
 
+def _excel_cell(value: Any) -> Any:
+    """Passes through values xlsxwriter writes natively and stringifies anything else (lists, dicts, ...)."""
+    return value if value is None or isinstance(value, (str, int, float, bool)) else str(value)
+
 def create_pdf_report(analysis_data: Dict[Any, Any]) -> bytes:
     """Generates a professional PDF summary report from the final analysis data."""
     # --- Extract data from the new, more detailed structure ---
@@ -67,43 +71,49 @@ def create_pdf_report(analysis_data: Dict[Any, Any]) -> bytes:
             pdf.multi_cell(w=190, h=5, txt=f"- {safe_warning}", border=0, align='L')
         pdf.set_text_color(0, 0, 0)
 
-    return pdf.output()
+    return bytes(pdf.output())
 
 
 def create_excel_report(analysis_data: Dict[Any, Any]) -> bytes:
     """Generates a multi-sheet Excel summary report with all the new data."""
     output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        
-        # --- Sheet 1: Tax Summary ---
-        summary_data = analysis_data.get("tax_return_summary", {}).get("breakdown", {})
-        df_summary = pd.DataFrame(summary_data.items(), columns=["Line Item", "Value"])
-        df_summary.to_excel(writer, sheet_name='Tax Summary', index=False, startrow=1)
-        
-        # --- NEW: Sheet 2: File Processing Log ---
-        metadata = analysis_data.get("file_metadata", [])
-        if metadata:
-            df_meta = pd.DataFrame(metadata)
-            df_meta.to_excel(writer, sheet_name='File Processing Log', index=False)
-            worksheet_meta = writer.sheets['File Processing Log']
-            worksheet_meta.set_column('A:D', 30)
+    # nan_inf_to_errors writes NaN/Inf as Excel error cells instead of raising.
+    workbook = xlsxwriter.Workbook(output, {'in_memory': True, 'nan_inf_to_errors': True})
+    # Matches the header style pandas used to apply when these sheets were written via DataFrame.to_excel.
+    column_header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
 
-        # --- NEW: Sheet 3: Audit Flags ---
-        audit_flags = analysis_data.get("audit_flags", [])
-        if audit_flags:
-            df_flags = pd.DataFrame(audit_flags, columns=["Audit Flags & Notes"])
-            df_flags.to_excel(writer, sheet_name='Audit Flags', index=False)
-            worksheet_flags = writer.sheets['Audit Flags']
-            worksheet_flags.set_column('A:A', 80)
-        
-        # Apply some formatting to the main summary sheet
-        workbook = writer.book
-        worksheet_summary = writer.sheets['Tax Summary']
-        header_format = workbook.add_format({'bold': True, 'font_size': 14, 'align': 'center', 'valign': 'vcenter'})
-        worksheet_summary.merge_range('A1:B1', 'Corporate Tax Summary Report', header_format)
-        worksheet_summary.set_row(0, 30)
-        worksheet_summary.set_column('A:A', 35)
-        worksheet_summary.set_column('B:B', 20)
+    # --- Sheet 1: Tax Summary ---
+    summary_data = analysis_data.get("tax_return_summary", {}).get("breakdown", {})
+    worksheet_summary = workbook.add_worksheet('Tax Summary')
+    worksheet_summary.write_row(1, 0, ["Line Item", "Value"], column_header_format)
+    for row, (label, value) in enumerate(summary_data.items(), start=2):
+        worksheet_summary.write(row, 0, _excel_cell(label))
+        worksheet_summary.write(row, 1, _excel_cell(value))
+
+    # --- NEW: Sheet 2: File Processing Log ---
+    metadata = analysis_data.get("file_metadata", [])
+    if metadata:
+        worksheet_meta = workbook.add_worksheet('File Processing Log')
+        columns = list(dict.fromkeys(key for entry in metadata for key in entry))
+        worksheet_meta.write_row(0, 0, [_excel_cell(column) for column in columns], column_header_format)
+        for row, entry in enumerate(metadata, start=1):
+            worksheet_meta.write_row(row, 0, [_excel_cell(entry.get(column)) for column in columns])
+        worksheet_meta.set_column('A:D', 30)
+
+    # --- NEW: Sheet 3: Audit Flags ---
+    audit_flags = analysis_data.get("audit_flags", [])
+    if audit_flags:
+        worksheet_flags = workbook.add_worksheet('Audit Flags')
+        worksheet_flags.write(0, 0, "Audit Flags & Notes", column_header_format)
+        worksheet_flags.write_column(1, 0, [_excel_cell(flag) for flag in audit_flags])
+        worksheet_flags.set_column('A:A', 80)
+    
+    # Apply some formatting to the main summary sheet
+    header_format = workbook.add_format({'bold': True, 'font_size': 14, 'align': 'center', 'valign': 'vcenter'})
+    worksheet_summary.merge_range('A1:B1', 'Corporate Tax Summary Report', header_format)
+    worksheet_summary.set_row(0, 30)
+    worksheet_summary.set_column('A:A', 35)
+    worksheet_summary.set_column('B:B', 20)
 
-    output.seek(0)
+    workbook.close()
     return output.getvalue()